@@ -0,0 +1,236 @@
+"""Benchmarks for the image processing functions in main.py.
+
+Run from the repository root:
+
+    python benchmark.py                    # everything
+    python benchmark.py tools --sizes 1024x768 --formats JPEG
+    python benchmark.py fast-downscale bulk
+    python benchmark.py meme --sizes 6000x4000
+
+Each case runs in a fresh process so the reported peak RSS belongs to that case
+alone. Inputs are synthetic and deterministic, so runs on the same machine are
+comparable. The stage columns are the medians of the per-stage timings the app
+records for Server-Timing and /metrics.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import textwrap
+import time
+
+from PIL import Image, ImageDraw, ImageFont
+from werkzeug.datastructures import FileStorage, MultiDict
+
+import main
+
+STAGES = ('decode', 'transform', 'resample', 'encode', 'write')
+
+
+def synthetic_image(width, height, fmt='JPEG'):
+    """Encode a deterministic photo-like test image (gradients, shapes and noise)."""
+    img = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    draw = ImageDraw.Draw(img)
+    for i in range(24):
+        x, y = (i * 7919) % width, (i * 104729) % height
+        draw.ellipse((x, y, x + width // 6, y + height // 6), fill=((i * 40) % 256, (i * 90) % 256, (i * 150) % 256))
+    noise = Image.effect_noise((width, height), 24).convert('RGB')
+    img = Image.blend(img, noise, 0.15)
+    img_io = io.BytesIO()
+    img.save(img_io, fmt, quality=92) if fmt in ('JPEG', 'WEBP') else img.save(img_io, fmt)
+    return img_io.getvalue()
+
+
+def _windows_peak_rss_mb():
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + [
+            (name, ctypes.c_size_t) for name in (
+                'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+
+    kernel32, psapi = ctypes.WinDLL('kernel32'), ctypes.WinDLL('psapi')
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD]
+    counters = PROCESS_MEMORY_COUNTERS(cb=ctypes.sizeof(PROCESS_MEMORY_COUNTERS))
+    psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+    return counters.PeakWorkingSetSize / (1024 * 1024)
+
+
+def _peak_rss_mb():
+    # VmHWM starts fresh on exec; ru_maxrss keeps the parent's high-water mark on Linux.
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if sys.platform == 'win32':
+        return _windows_peak_rss_mb()
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _run_case(results, func, form, data, repeat, count):
+    baseline = _peak_rss_mb()
+    timings, stages = [], {stage: [] for stage in STAGES}
+    for _ in range(repeat):
+        uploads = [FileStorage(stream=io.BytesIO(data), filename='bench') for _ in range(count or 1)]
+        stage_timings = main.start_timings()
+        start = time.perf_counter()
+        file_path = func(MultiDict(form), uploads if count else uploads[0])
+        timings.append(time.perf_counter() - start)
+        for stage in STAGES:
+            stages[stage].append(stage_timings.get(stage, 0.0))
+        if file_path:
+            os.remove(file_path)
+    main.shutdown_bulk_pool()
+    results.put((statistics.median(timings), _peak_rss_mb() - baseline,
+                 {stage: statistics.median(values) for stage, values in stages.items()}))
+
+
+def run_case(func, form, data, repeat=3, count=None):
+    """Return (median seconds, peak RSS growth in MB, median seconds per stage).
+
+    func is called as func(form, upload), or func(form, [upload] * count) when count is given.
+    """
+    # spawn rather than fork, so the child starts without this process's memory.
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_run_case, args=(results, func, form, data, repeat, count))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def _parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def _tool_cases(width, height, fmt):
+    convert_to = 'jpeg' if fmt == 'WEBP' else 'webp'
+    operations = [{'op': 'crop', 'crop_x': 0, 'crop_y': 0, 'crop_width': width // 2, 'crop_height': height // 2},
+                  {'op': 'transpose', 'operation': 'rotate_90'},
+                  {'op': 'resize', 'unit': 'px', 'width': 800, 'height': 800, 'aspect_ratio': True},
+                  {'op': 'convert', 'format': 'webp', 'quality': 80}]
+    return [
+        ('resize_by_dimension', main.resize_by_dimension, {'unit': 'px', 'width': '800', 'height': '800', 'format': 'jpeg', 'aspect_ratio': 'true'}),
+        ('reduce_by_filesize', main.reduce_by_filesize, {'target_size': '200', 'size_unit': 'KB', 'format': 'jpeg'}),
+        ('convert_image', main.convert_image, {'format': convert_to}),
+        ('crop_image', main.crop_image, {'crop_x': '0', 'crop_y': '0', 'crop_width': str(width // 2), 'crop_height': str(height // 2)}),
+        ('transform_image', main.transform_image, {'operation': 'rotate_90'}),
+        ('generate_meme', main.generate_meme, {'top_text': 'when the benchmark', 'bottom_text': 'finally finishes'}),
+        ('process_pipeline', main.process_pipeline, {'operations': json.dumps(operations)}),
+    ]
+
+
+def _print_header(first_column):
+    print(f"{first_column:<22} {'source':<16} {'median ms':>10} {'MP/s':>7} {'peak MB':>8}  " + ' '.join(f"{stage:>9}" for stage in STAGES))
+
+
+def _print_row(name, source, megapixels, seconds, peak, stages):
+    print(f"{name:<22} {source:<16} {seconds * 1000:>10.1f} {megapixels / seconds:>7.1f} {peak:>8.1f}  "
+          + ' '.join(f"{stages[stage] * 1000:>9.1f}" for stage in STAGES))
+
+
+def bench_tools(args):
+    print('Single-image tools (stage columns in ms)')
+    _print_header('tool')
+    for size in args.sizes:
+        width, height = _parse_size(size)
+        for fmt in args.formats:
+            data = synthetic_image(width, height, fmt)
+            for name, func, form in _tool_cases(width, height, fmt):
+                seconds, peak, stages = run_case(func, form, data, args.repeat)
+                _print_row(name, f"{size} {fmt}", width * height / 1e6, seconds, peak, stages)
+
+
+def bench_bulk(args):
+    print(f"bulk_resize_images: {args.bulk_count} JPEGs -> 800x800 on {main.BULK_WORKERS} worker(s) (peak MB excludes pool processes)")
+    _print_header('images/s')
+    form = {'unit': 'px', 'width': '800', 'height': '800', 'format': 'jpeg', 'aspect_ratio': 'true'}
+    for size in args.sizes:
+        width, height = _parse_size(size)
+        data = synthetic_image(width, height)
+        seconds, peak, stages = run_case(main.bulk_resize_images, form, data, args.repeat, count=args.bulk_count)
+        _print_row(f"{args.bulk_count / seconds:.1f}", f"{size} JPEG", width * height * args.bulk_count / 1e6, seconds, peak, stages)
+
+
+def bench_fast_downscale(args):
+    print('resize_by_dimension: JPEG -> 800x800 (aspect ratio kept)')
+    _print_header('mode')
+    for width, height in [(4000, 3000), (6000, 4000), (8160, 6120)]:
+        data = synthetic_image(width, height)
+        for fast in ('false', 'true'):
+            form = {'unit': 'px', 'width': '800', 'height': '800', 'format': 'jpeg', 'aspect_ratio': 'true', 'fast_downscale': fast}
+            seconds, peak, stages = run_case(main.resize_by_dimension, form, data, args.repeat)
+            _print_row('draft' if fast == 'true' else 'full', f"{width}x{height}", width * height / 1e6, seconds, peak, stages)
+
+
+def legacy_meme(form, image_file):
+    """generate_meme as it was before fonts were cached and outlines stroked, for comparison."""
+    img = main.open_image(image_file.stream)
+    with main.timed_stage('transform'):
+        img = img.convert('RGBA')
+        draw = ImageDraw.Draw(img)
+        font = ImageFont.truetype(main.MEME_FONT_PATH, size=int(img.width / 10))
+        for text, position in ((form.get('top_text', '').upper(), 'top'), (form.get('bottom_text', '').upper(), 'bottom')):
+            lines = textwrap.wrap(text, width=20)
+            y = 10 if position == 'top' else img.height - sum(font.getbbox(line)[3] + 5 for line in lines)
+            for line in lines:
+                line_width, line_height = font.getbbox(line)[2], font.getbbox(line)[3]
+                x = (img.width - line_width) / 2
+                for dx, dy in ((-2, -2), (2, -2), (-2, 2), (2, 2)):
+                    draw.text((x + dx, y + dy), line, font=font, fill='black')
+                draw.text((x, y), line, font=font, fill='white')
+                y += line_height + 5
+    with main.timed_stage('encode'):
+        img = img.convert('RGB')
+    return main._save_output(img, 'legacy-meme.jpg', 'JPEG')
+
+
+def bench_meme(args):
+    print('generate_meme: two lines of top and bottom text on a JPEG (stage columns in ms)')
+    _print_header('renderer')
+    form = {'top_text': 'when the benchmark', 'bottom_text': 'finally finishes'}
+    for size in args.sizes:
+        width, height = _parse_size(size)
+        data = synthetic_image(width, height)
+        for name, func in (('legacy', legacy_meme), ('stroke', main.generate_meme)):
+            seconds, peak, stages = run_case(func, form, data, args.repeat)
+            _print_row(name, f"{size} JPEG", width * height / 1e6, seconds, peak, stages)
+
+
+BENCHMARKS = {
+    'tools': bench_tools,
+    'bulk': bench_bulk,
+    'fast-downscale': bench_fast_downscale,
+    'meme': bench_meme,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*', help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--sizes', nargs='+', default=['1024x768', '3000x2000', '6000x4000'])
+    parser.add_argument('--formats', nargs='+', default=['JPEG', 'PNG', 'WEBP'], choices=['JPEG', 'PNG', 'WEBP'])
+    parser.add_argument('--bulk-count', type=int, default=16)
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(sorted(unknown))}")
+    os.makedirs(main.TEMP_DIR, exist_ok=True)
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name](args)
+        print()
@@ -1,213 +1,1247 @@
-from flask import Flask, render_template, request, send_file, jsonify, url_for
-from PIL import Image, ImageDraw, ImageFont
+from flask import Flask, render_template, request, send_file, jsonify, url_for, g
+from werkzeug.datastructures import FileStorage
+from PIL import Image, ImageDraw, ImageFont, JpegImagePlugin
 import io
 import os
+import shutil
+import tempfile
+import json
+import hashlib
 import uuid
 import zipfile
-import shutil
+import math
 import textwrap
+import time
+import queue
+import threading
+import multiprocessing
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 app = Flask(__name__)
 app.secret_key = 'a_super_secret_key_for_production'
 
+# Every tool writes its output into TEMP_DIR, next to this file rather than the working
+# directory, and serves it from /temp/<filename>.
+TEMP_DIR = os.path.join(app.root_path, 'temp')
+os.makedirs(TEMP_DIR, exist_ok=True)
 
-# --- Core processing functions ---
+# Bulk resizing fans out over a process pool; results are zipped as they complete.
+# Workers are never forked from this multi-threaded process, where a child could
+# inherit a lock (logging, for one) that another thread was holding.
+BULK_WORKERS = os.cpu_count() or 1
+BULK_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+BULK_MAX_IN_FLIGHT = BULK_WORKERS * 2
+_bulk_pool = None
+_bulk_pool_lock = threading.Lock()
+
+# Large JPEGs are decoded at reduced scale when the target is at least
+# FAST_DOWNSCALE_MIN_RATIO times smaller; send fast_downscale=false to decode in full.
+FAST_DOWNSCALE_MIN_RATIO = 2
+FAST_DOWNSCALE_REDUCING_GAP = 2.0
+
+# Target file size search: a cheap estimate on a downscaled copy seeds a bisection
+# over quality; if even the lowest quality is too big, the image is shrunk.
+FILESIZE_MIN_QUALITY = 5
+FILESIZE_MAX_QUALITY = 95
+FILESIZE_MAX_ENCODES = 6
+FILESIZE_QUALITY_TOLERANCE = 3
+FILESIZE_MAX_RESIZES = 3
+FILESIZE_SEED_STEP = 8
+FILESIZE_SAMPLE_PIXELS = 256 * 256
+
+# Meme text is drawn straight onto the frame with FreeType's stroker for the outline;
+# fonts are loaded once per size and kept for the life of the process.
+MEME_FONT_PATH = os.path.join(app.root_path, 'static', 'impact.ttf')
+MEME_FONT_CACHE_SIZE = 64
+MEME_STROKE_WIDTH = 2
+MEME_LINE_SPACING = 5
+MEME_DRAW_MODES = ('RGB', 'RGBA', 'L', 'LA')
+
+
+# --- Instrumentation ---
+# Processing code wraps its phases in timed_stage(); the durations land in the
+# current request's (or job's) timings dict and in the /metrics histograms.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_timings = threading.local()
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+def start_timings():
+    _timings.current = {}
+    return _timings.current
+
+def current_timings():
+    return getattr(_timings, 'current', None)
+
+def observe(metric, label, value, seconds):
+    with _metrics_lock:
+        series = _metrics.setdefault((metric, label, value), {'buckets': [0] * len(METRICS_BUCKETS), 'sum': 0.0, 'count': 0})
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                series['buckets'][i] += 1
+                break
+        series['sum'] += seconds
+        series['count'] += 1
 
-def resize_by_dimension(form, image_file):
+def merge_timings(timings):
+    # Adds timings measured elsewhere (e.g. in a pool process) to the current ones.
+    current = current_timings()
+    if current is not None:
+        for stage, seconds in timings.items():
+            current[stage] = current.get(stage, 0.0) + seconds
+
+def record_timings(timings):
+    for stage, seconds in timings.items():
+        observe('image_stage_duration_seconds', 'stage', stage, seconds)
+
+@contextmanager
+def timed_stage(name):
+    start = time.perf_counter()
     try:
-        unit = form.get('unit')
-        width = float(form.get('width'))
-        height = float(form.get('height'))
-        output_format = form.get('format', 'jpeg')
-        maintain_aspect_ratio = form.get('aspect_ratio')
-        transform = form.get('transform')
-        if unit in ['cm', 'mm']:
-            dpi = int(form.get('dpi', 96))
-            INCH_TO_CM = 2.54
-            if unit == 'cm':
-                width_px, height_px = round((width / INCH_TO_CM) * dpi), round((height / INCH_TO_CM) * dpi)
-            else:
-                width_px, height_px = round((width / (INCH_TO_CM * 10)) * dpi), round((height / (INCH_TO_CM * 10)) * dpi)
-        else:
-            width_px, height_px = int(width), int(height)
-        img = Image.open(image_file.stream)
-        if transform == 'rotate_90': img = img.transpose(Image.Transpose.ROTATE_90)
-        elif transform == 'rotate_180': img = img.transpose(Image.Transpose.ROTATE_180)
-        elif transform == 'rotate_270': img = img.transpose(Image.Transpose.ROTATE_270)
-        elif transform == 'flip_horizontal': img = img.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
-        elif transform == 'flip_vertical': img = img.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+        yield
+    finally:
+        timings = current_timings()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+def render_metrics():
+    """Render the histograms in the Prometheus text exposition format."""
+    lines, seen = [], set()
+    with _metrics_lock:
+        for (metric, label, value), series in sorted(_metrics.items()):
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS, series['buckets']):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{label}="{value}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{{label}="{value}",le="+Inf"}} {series["count"]}')
+            lines.append(f'{metric}_sum{{{label}="{value}"}} {series["sum"]:.6f}')
+            lines.append(f'{metric}_count{{{label}="{value}"}} {series["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+# --- Core processing functions ---
+# Each stage takes a decoded image plus a dict-like of the tool's form fields and
+# returns the new image. The tool functions below and /pipeline chain stages on a
+# single decoded image and encode once at the end.
+
+def _dimension_params(form):
+    unit = form.get('unit')
+    width = float(form.get('width'))
+    height = float(form.get('height'))
+    if unit in ['cm', 'mm']:
+        dpi = int(form.get('dpi', 96))
+        INCH_TO_CM = 2.54
+        if unit == 'cm':
+            return round((width / INCH_TO_CM) * dpi), round((height / INCH_TO_CM) * dpi)
+        return round((width / (INCH_TO_CM * 10)) * dpi), round((height / (INCH_TO_CM * 10)) * dpi)
+    return int(width), int(height)
+
+def _is_jpeg(img):
+    # Camera and phone photos often open as MPO, which is a JPEG with extra frames.
+    return isinstance(img, JpegImagePlugin.JpegImageFile)
+
+def _draft_for_target(img, width_px, height_px, transform):
+    # JPEG can decode at 1/2, 1/4 or 1/8 scale in the DCT domain. Pillow picks the
+    # smallest scale that is still at least the requested size, so the final
+    # resample below always works from more pixels than it outputs. This is a
+    # no-op once the image has been loaded, e.g. by an earlier pipeline stage.
+    if not _is_jpeg(img):
+        return
+    if transform in ('rotate_90', 'rotate_270'):
+        width_px, height_px = height_px, width_px
+    if min(img.width / width_px, img.height / height_px) >= FAST_DOWNSCALE_MIN_RATIO:
+        img.draft(img.mode, (width_px, height_px))
+
+TRANSPOSE_OPERATIONS = {
+    'rotate_90': Image.Transpose.ROTATE_90,
+    'rotate_180': Image.Transpose.ROTATE_180,
+    'rotate_270': Image.Transpose.ROTATE_270,
+    'flip_horizontal': Image.Transpose.FLIP_LEFT_RIGHT,
+    'flip_vertical': Image.Transpose.FLIP_TOP_BOTTOM,
+}
+
+def _fast_downscale(form):
+    # Pipelines send JSON booleans, forms send strings.
+    return str(form.get('fast_downscale', 'true')).lower() != 'false'
+
+def open_image(source, resize_form=None):
+    """Open and fully decode an upload. Pass the resize parameters to allow JPEG draft decoding."""
+    with timed_stage('decode'):
+        img = Image.open(source)
+        if resize_form is not None and _fast_downscale(resize_form):
+            _draft_for_target(img, *_dimension_params(resize_form), resize_form.get('transform'))
+        img.load()
+    return img
+
+def resize_stage(img, form):
+    width_px, height_px = _dimension_params(form)
+    maintain_aspect_ratio = form.get('aspect_ratio')
+    transform = form.get('transform')
+    fast_downscale = _fast_downscale(form)
+    if fast_downscale:
+        _draft_for_target(img, width_px, height_px, transform)
+    with timed_stage('resample'):
+        if transform in TRANSPOSE_OPERATIONS:
+            img = img.transpose(TRANSPOSE_OPERATIONS[transform])
         if maintain_aspect_ratio:
-            img.thumbnail((width_px, height_px))
-            resized_img = img
+            img.thumbnail((width_px, height_px), reducing_gap=FAST_DOWNSCALE_REDUCING_GAP if fast_downscale else None)
+            return img
+        return img.resize((width_px, height_px), Image.Resampling.LANCZOS,
+                          reducing_gap=FAST_DOWNSCALE_REDUCING_GAP if fast_downscale else None)
+
+def crop_stage(img, form):
+    x = int(float(form.get('crop_x')))
+    y = int(float(form.get('crop_y')))
+    width = int(float(form.get('crop_width')))
+    height = int(float(form.get('crop_height')))
+    with timed_stage('transform'):
+        return img.crop((x, y, x + width, y + height))
+
+def transpose_stage(img, form):
+    operation = form.get('operation')
+    if operation not in TRANSPOSE_OPERATIONS:
+        raise ValueError(f"unknown transform {operation!r}")
+    with timed_stage('transform'):
+        return img.transpose(TRANSPOSE_OPERATIONS[operation])
+
+def meme_stage(img, form):
+    with timed_stage('transform'):
+        return _draw_meme_text(img, form)
+
+@lru_cache(maxsize=MEME_FONT_CACHE_SIZE)
+def _meme_font(size):
+    return ImageFont.truetype(MEME_FONT_PATH, size=size)
+
+def _draw_meme_text(img, form):
+    top_text = form.get('top_text', '').upper()
+    bottom_text = form.get('bottom_text', '').upper()
+    if not (top_text or bottom_text):
+        return img
+    # Opaque ink needs no alpha channel: drawing only blends the pixels under each glyph.
+    if img.mode not in MEME_DRAW_MODES:
+        img = img.convert('RGBA')
+    draw = ImageDraw.Draw(img)
+    font = _meme_font(int(img.width / 10))
+
+    def draw_text_with_outline(text, position):
+        lines = [(line, font.getbbox(line)) for line in textwrap.wrap(text, width=20)]
+        if position == 'top':
+            y = 10
+        else: # bottom
+            y = img.height - sum(bbox[3] + MEME_LINE_SPACING for _, bbox in lines)
+
+        for line, bbox in lines:
+            x = (img.width - bbox[2]) / 2
+            draw.text((x, y), line, font=font, fill='white',
+                      stroke_width=MEME_STROKE_WIDTH, stroke_fill='black')
+            y += bbox[3] + MEME_LINE_SPACING
+
+    if top_text:
+        draw_text_with_outline(top_text, 'top')
+    if bottom_text:
+        draw_text_with_outline(bottom_text, 'bottom')
+    return img
+
+def _prepare_for_format(img, output_format):
+    with timed_stage('encode'):
+        if output_format == 'jpeg' and img.mode not in ('RGB', 'L', 'CMYK'):
+            return img.convert('RGB')
+        if output_format == 'webp' and img.mode not in ('RGB', 'RGBA'):
+            return img.convert('RGBA' if 'transparency' in img.info or 'A' in img.getbands() else 'RGB')
+        return img
+
+def _save_options(form):
+    output_format = form.get('format', 'jpeg')
+    format_to_save = 'JPEG' if output_format == 'jpeg' else output_format.upper()
+    save_params = {}
+    if output_format in ['jpeg', 'webp']:
+        save_params['quality'] = int(form.get('quality', 85))
+    return format_to_save, save_params
+
+def _save_output(img, unique_filename, format_to_save, out=None, **save_params):
+    # With an out buffer the image is encoded in memory and the bare filename is returned;
+    # otherwise it is written to TEMP_DIR and the path is returned.
+    with timed_stage('encode'):
+        if out is not None:
+            img.save(out, format_to_save, **save_params)
+            return unique_filename
+        img_io = io.BytesIO()
+        img.save(img_io, format_to_save, **save_params)
+    return _write_output(img_io.getbuffer(), unique_filename)
+
+def _write_output(data, unique_filename, out=None):
+    # Like _save_output, for results that are already encoded.
+    with timed_stage('write'):
+        if out is not None:
+            out.write(data)
+            return unique_filename
+        save_path = os.path.join(TEMP_DIR, unique_filename)
+        with open(save_path, 'wb') as f:
+            f.write(data)
+    return save_path
+
+def _encode_at_quality(img, format_to_save, quality):
+    img_io = io.BytesIO()
+    with timed_stage('encode'):
+        if format_to_save == 'JPEG':
+            img.save(img_io, format='JPEG', quality=quality, optimize=True)
         else:
-            resized_img = img.resize((width_px, height_px), Image.Resampling.LANCZOS)
-        if output_format == 'jpeg' and resized_img.mode == 'RGBA':
-            resized_img = resized_img.convert('RGB')
-        format_to_save = 'JPEG' if output_format == 'jpeg' else output_format.upper()
+            img.save(img_io, format=format_to_save, quality=quality, method=4)
+    return img_io.getvalue()
+
+def _estimate_quality(img, format_to_save, target_bytes, stats):
+    # Bisect on a small copy of the image (cheap encodes) with the byte budget scaled by pixel count.
+    full_pixels = img.width * img.height
+    ratio = (FILESIZE_SAMPLE_PIXELS / full_pixels) ** 0.5
+    if ratio >= 1:
+        return (FILESIZE_MIN_QUALITY + FILESIZE_MAX_QUALITY) // 2
+    # NEAREST keeps the pixel-level texture that dominates encoded size; smoothing would hide it.
+    sample = img.resize((max(1, round(img.width * ratio)), max(1, round(img.height * ratio))), Image.Resampling.NEAREST)
+    tiny = sample.resize((8, 8))
+    pixel_share = (sample.width * sample.height) / full_pixels
+    lo, hi = FILESIZE_MIN_QUALITY, FILESIZE_MAX_QUALITY
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        # Headers and tables cost the same at any size, so only scale the remainder.
+        overhead = len(_encode_at_quality(tiny, format_to_save, mid))
+        sample_target = overhead + (target_bytes - overhead) * pixel_share
+        stats['sample_encodes'] += 2
+        if len(_encode_at_quality(sample, format_to_save, mid)) <= sample_target: lo = mid
+        else: hi = mid - 1
+    return lo
+
+def _search_quality(img, format_to_save, target_bytes, stats):
+    """Find the highest quality that fits target_bytes, starting from an estimate.
+
+    Returns (quality, data) for the best fit, or (None, smallest_data) if even the
+    lowest quality tried is over target.
+    """
+    lo, hi = FILESIZE_MIN_QUALITY, FILESIZE_MAX_QUALITY
+    quality = _estimate_quality(img, format_to_save, target_bytes, stats)
+    step = FILESIZE_SEED_STEP
+    best, smallest, fit, miss = None, None, None, None
+    for _ in range(FILESIZE_MAX_ENCODES):
+        data = _encode_at_quality(img, format_to_save, quality)
+        stats['encodes'] += 1
+        if len(data) <= target_bytes:
+            best, fit, lo = (quality, data), (quality, len(data)), quality + 1
+        else:
+            smallest, miss, hi = data, (quality, len(data)), quality - 1
+        if lo > hi or (best and hi - lo < FILESIZE_QUALITY_TOLERANCE):
+            break
+        if miss is None:
+            quality, step = min(hi, quality + step), step * 2
+        elif fit is None:
+            quality, step = max(lo, quality - step), step * 2
+        else:
+            # Bracketed: file size grows roughly exponentially with quality, so
+            # interpolate on log(size) between the nearest fitting and missing probes.
+            (q0, s0), (q1, s1) = fit, miss
+            t = (math.log(target_bytes) - math.log(s0)) / (math.log(s1) - math.log(s0))
+            quality = min(hi, max(lo, round(q0 + t * (q1 - q0))))
+    if best is None and lo <= hi:
+        # Ran out of encodes before probing the bottom of the range.
+        data = _encode_at_quality(img, format_to_save, FILESIZE_MIN_QUALITY)
+        stats['encodes'] += 1
+        if len(data) <= target_bytes:
+            return FILESIZE_MIN_QUALITY, data
+        smallest = data
+    return best if best else (None, smallest)
+
+def _encode_to_target(img, output_format, target_bytes, stats):
+    """Encode img as JPEG or WEBP no larger than target_bytes, shrinking it if needed.
+
+    stats['encodes'] counts full-size encodes, across every resize, and
+    stats['sample_encodes'] the cheap ones on the downscaled estimation copy.
+    """
+    stats['encodes'] = stats['sample_encodes'] = 0
+    format_to_save = output_format.upper()
+    img = _prepare_for_format(img, output_format)
+    quality, data = _search_quality(img, format_to_save, target_bytes, stats)
+    # No quality setting is small enough: shrink the image and search again.
+    for _ in range(FILESIZE_MAX_RESIZES):
+        if quality is not None:
+            break
+        scale = (target_bytes / len(data)) ** 0.5 * 0.9
+        new_size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        if new_size == img.size:
+            break
+        with timed_stage('resample'):
+            img = img.resize(new_size, Image.Resampling.LANCZOS)
+        quality, data = _search_quality(img, format_to_save, target_bytes, stats)
+    stats.update({'quality': quality, 'width': img.width, 'height': img.height,
+                  'bytes': len(data), 'target_met': quality is not None})
+    return data
+
+def _target_bytes(form):
+    target_size = int(form.get('target_size'))
+    if target_size <= 0:
+        raise ValueError('target_size must be positive')
+    size_unit = form.get('size_unit')
+    return target_size * 1024 if size_unit == 'KB' else target_size * 1024 * 1024
+
+def resize_by_dimension(form, image_file, out=None):
+    try:
+        output_format = form.get('format', 'jpeg')
+        resized_img = _prepare_for_format(resize_stage(open_image(image_file.stream, form), form), output_format)
+        format_to_save, save_params = _save_options(form)
         unique_filename = f"{uuid.uuid4()}.{output_format}"
-        save_path = os.path.join('temp', unique_filename)
-        save_params = {}
-        if output_format in ['jpeg', 'webp']:
-            save_params['quality'] = int(form.get('quality', 85))
-        resized_img.save(save_path, format_to_save, **save_params)
-        return save_path
-    except Exception as e:
-        print(f"Error in resize_by_dimension: {e}")
+        return _save_output(resized_img, unique_filename, format_to_save, out, **save_params)
+    except Exception:
+        app.logger.exception("Error in resize_by_dimension")
         return None
 
-def reduce_by_filesize(form, image_file):
+def reduce_by_filesize(form, image_file, stats=None, out=None):
     try:
-        target_size = int(form.get('target_size'))
-        size_unit = form.get('size_unit')
-        target_bytes = target_size * 1024 if size_unit == 'KB' else target_size * 1024 * 1024
-        img = Image.open(image_file.stream)
-        if img.mode == 'RGBA':
-            img = img.convert('RGB')
-        quality, step, img_io = 95, 5, io.BytesIO()
-        while quality > 0:
-            img_io.seek(0); img_io.truncate()
-            img.save(img_io, format='JPEG', quality=quality, optimize=True)
-            if img_io.tell() <= target_bytes:
-                break
-            quality -= step
-        unique_filename = f"{uuid.uuid4()}.jpg"
-        save_path = os.path.join('temp', unique_filename)
-        with open(save_path, 'wb') as f:
-            f.write(img_io.getvalue())
-        return save_path
-    except Exception as e:
-        print(f"Error in reduce_by_filesize: {e}")
+        stats = {} if stats is None else stats
+        output_format = 'webp' if form.get('format') == 'webp' else 'jpeg'
+        data = _encode_to_target(open_image(image_file.stream), output_format, _target_bytes(form), stats)
+        unique_filename = f"{uuid.uuid4()}.{'jpg' if output_format == 'jpeg' else 'webp'}"
+        return _write_output(data, unique_filename, out)
+    except Exception:
+        app.logger.exception("Error in reduce_by_filesize")
         return None
 
-def crop_image(form, image_file):
+def crop_image(form, image_file, out=None):
     try:
-        img = Image.open(image_file.stream)
-        x = int(float(form.get('crop_x')))
-        y = int(float(form.get('crop_y')))
-        width = int(float(form.get('crop_width')))
-        height = int(float(form.get('crop_height')))
-        box = (x, y, x + width, y + height)
-        cropped_img = img.crop(box)
+        img = open_image(image_file.stream)
         original_format = img.format or 'PNG'
+        cropped_img = crop_stage(img, form)
         unique_filename = f"cropped-{uuid.uuid4()}.{original_format.lower()}"
-        save_path = os.path.join('temp', unique_filename)
-        cropped_img.save(save_path, format=original_format)
-        return save_path
-    except Exception as e:
-        print(f"Error in crop_image: {e}")
+        return _save_output(cropped_img, unique_filename, original_format, out)
+    except Exception:
+        app.logger.exception("Error in crop_image")
         return None
 
-def bulk_resize_images(form, image_files):
+def convert_image(form, image_file, out=None):
     try:
-        job_id = str(uuid.uuid4())
-        job_folder = os.path.join('temp', job_id)
-        os.makedirs(job_folder)
-        for image_file in image_files:
-            try:
-                resized_path = resize_by_dimension(form, image_file)
-                if resized_path:
-                    shutil.move(resized_path, os.path.join(job_folder, os.path.basename(resized_path)))
-            except Exception as e:
-                print(f"Could not process {image_file.filename} in bulk: {e}")
-                continue
-        zip_filename = f"{job_id}.zip"
-        zip_path = os.path.join('temp', zip_filename)
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for root, _, files in os.walk(job_folder):
-                for file in files:
-                    zipf.write(os.path.join(root, file), arcname=file)
-        shutil.rmtree(job_folder)
-        return zip_path
-    except Exception as e:
-        if 'job_folder' in locals() and os.path.exists(job_folder):
-            shutil.rmtree(job_folder)
-        print(f"Error in bulk_resize_images: {e}")
-        return None
-
-def convert_image(form, image_file):
-    try:
-        img = Image.open(image_file.stream)
         output_format = form.get('format', 'jpeg')
-        if output_format == 'jpeg' and img.mode in ('RGBA', 'P'):
-            img = img.convert('RGB')
+        img = _prepare_for_format(open_image(image_file.stream), output_format)
         format_to_save = 'JPEG' if output_format == 'jpeg' else output_format.upper()
         unique_filename = f"converted-{uuid.uuid4()}.{output_format}"
-        save_path = os.path.join('temp', unique_filename)
-        img.save(save_path, format=format_to_save)
-        return save_path
-    except Exception as e:
-        print(f"Error in convert_image: {e}")
+        return _save_output(img, unique_filename, format_to_save, out)
+    except Exception:
+        app.logger.exception("Error in convert_image")
         return None
 
-def transform_image(form, image_file):
+def transform_image(form, image_file, out=None):
     try:
-        img = Image.open(image_file.stream)
-        operation = form.get('operation')
-        if operation == 'rotate_90': transformed_img = img.transpose(Image.Transpose.ROTATE_90)
-        elif operation == 'rotate_180': transformed_img = img.transpose(Image.Transpose.ROTATE_180)
-        elif operation == 'rotate_270': transformed_img = img.transpose(Image.Transpose.ROTATE_270)
-        elif operation == 'flip_horizontal': transformed_img = img.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
-        elif operation == 'flip_vertical': transformed_img = img.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
-        else: return None
+        img = open_image(image_file.stream)
         original_format = img.format or 'PNG'
+        transformed_img = transpose_stage(img, form)
         unique_filename = f"transformed-{uuid.uuid4()}.{original_format.lower()}"
-        save_path = os.path.join('temp', unique_filename)
-        transformed_img.save(save_path, format=original_format)
-        return save_path
+        return _save_output(transformed_img, unique_filename, original_format, out)
+    except Exception:
+        app.logger.exception("Error in transform_image")
+        return None
+
+def generate_meme(form, image_file, out=None):
+    try:
+        img = _prepare_for_format(meme_stage(open_image(image_file.stream), form), 'jpeg')
+        unique_filename = f"meme-{uuid.uuid4()}.jpg"
+        return _save_output(img, unique_filename, 'JPEG', out)
+    except Exception:
+        app.logger.exception("Error in generate_meme")
+        return None
+
+
+# --- Pipelines ---
+# A pipeline is a JSON list of operations such as
+#   [{"op": "crop", "crop_x": 0, "crop_y": 0, "crop_width": 800, "crop_height": 600},
+#    {"op": "transpose", "operation": "rotate_90"},
+#    {"op": "resize", "unit": "px", "width": 400, "height": 300, "aspect_ratio": true},
+#    {"op": "convert", "format": "webp", "quality": 80}]
+# Each operation takes the same fields as the matching tool's form. "convert" or
+# "filesize" may come last to choose the encoding; otherwise JPEG (including MPO),
+# PNG and WEBP sources keep their format and anything else is written as PNG.
+PIPELINE_STAGES = {'crop': crop_stage, 'transpose': transpose_stage, 'resize': resize_stage, 'meme': meme_stage}
+PIPELINE_ENCODERS = ('convert', 'filesize')
+PIPELINE_FORMATS = ('jpeg', 'png', 'webp')
+
+def _number_field(operation, key, convert=float):
+    try:
+        return convert(operation.get(key))
+    except (TypeError, ValueError):
+        raise ValueError(f"{key} must be a number") from None
+
+def _check_operation(operation):
+    # Reject fields the stage or encoder would only fail on after the image is decoded.
+    op = operation['op']
+    if op == 'resize':
+        _number_field(operation, 'width'), _number_field(operation, 'height')
+        if operation.get('unit') in ('cm', 'mm') and 'dpi' in operation:
+            _number_field(operation, 'dpi', int)
+        if min(_dimension_params(operation)) <= 0:
+            raise ValueError('width and height must be at least one pixel')
+    elif op == 'crop':
+        box = [_number_field(operation, key) for key in ('crop_x', 'crop_y', 'crop_width', 'crop_height')]
+        if int(box[2]) <= 0 or int(box[3]) <= 0:
+            raise ValueError('crop_width and crop_height must be at least one pixel')
+    elif op == 'transpose':
+        if operation.get('operation') not in TRANSPOSE_OPERATIONS:
+            raise ValueError(f"unknown transform {operation.get('operation')!r}")
+    elif op == 'meme':
+        if not all(isinstance(operation.get(key, ''), str) for key in ('top_text', 'bottom_text')):
+            raise ValueError('top_text and bottom_text must be strings')
+    elif op == 'convert':
+        if operation.get('format', 'jpeg') not in PIPELINE_FORMATS:
+            raise ValueError(f"format must be one of {', '.join(PIPELINE_FORMATS)}")
+        if 'quality' in operation:
+            _number_field(operation, 'quality', int)
+    elif op == 'filesize':
+        _number_field(operation, 'target_size', int)
+        _target_bytes(operation)
+        if operation.get('format', 'jpeg') not in ('jpeg', 'webp'):
+            raise ValueError('format must be jpeg or webp')
+
+def parse_operations(raw):
+    """Parse and validate a pipeline; raises ValueError with a readable message."""
+    operations = json.loads(raw) if isinstance(raw, str) else raw
+    if not isinstance(operations, list) or not operations:
+        raise ValueError('operations must be a non-empty JSON list')
+    for index, operation in enumerate(operations):
+        op = operation.get('op') if isinstance(operation, dict) else None
+        if op not in PIPELINE_STAGES and op not in PIPELINE_ENCODERS:
+            raise ValueError(f"operation {index}: unknown op {op!r}")
+        if op in PIPELINE_ENCODERS and index != len(operations) - 1:
+            raise ValueError(f"operation {index}: {op!r} must be the last operation")
+        try:
+            _check_operation(operation)
+        except ValueError as e:
+            raise ValueError(f"operation {index}: {e}") from None
+    return operations
+
+def run_operations(source, operations, stats=None):
+    """Decode source, apply operations and encode once. Returns (data, extension)."""
+    stats = {} if stats is None else stats
+    img = open_image(source, operations[0] if operations[0]['op'] == 'resize' else None)
+    source_format = 'JPEG' if _is_jpeg(img) else img.format if img.format in ('PNG', 'WEBP') else 'PNG'
+    for operation in operations:
+        if operation['op'] in PIPELINE_STAGES:
+            img = PIPELINE_STAGES[operation['op']](img, operation)
+    encoder = operations[-1] if operations[-1]['op'] in PIPELINE_ENCODERS else {}
+    if encoder.get('op') == 'filesize':
+        output_format = 'webp' if encoder.get('format') == 'webp' else 'jpeg'
+        return _encode_to_target(img, output_format, _target_bytes(encoder), stats), output_format
+    output_format = encoder.get('format', source_format.lower())
+    format_to_save, save_params = _save_options({'format': output_format, **encoder})
+    img = _prepare_for_format(img, output_format)
+    img_io = io.BytesIO()
+    with timed_stage('encode'):
+        img.save(img_io, format_to_save, **save_params)
+    return img_io.getvalue(), output_format
+
+def process_pipeline(form, image_file, stats=None, out=None):
+    try:
+        operations = parse_operations(form.get('operations'))
+        data, extension = run_operations(image_file.stream, operations, stats)
+        return _write_output(data, f"pipeline-{uuid.uuid4()}.{extension}", out)
+    except Exception:
+        app.logger.exception("Error in process_pipeline")
+        return None
+
+def _get_bulk_pool():
+    global _bulk_pool
+    with _bulk_pool_lock:
+        if _bulk_pool is None:
+            _bulk_pool = ProcessPoolExecutor(max_workers=BULK_WORKERS,
+                                             mp_context=multiprocessing.get_context(BULK_START_METHOD))
+        return _bulk_pool
+
+def _replace_broken_bulk_pool(pool):
+    # A pool whose worker died rejects all further work; the next caller gets a fresh one.
+    global _bulk_pool
+    with _bulk_pool_lock:
+        if _bulk_pool is pool:
+            _bulk_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def shutdown_bulk_pool():
+    # Needed where interpreter shutdown hooks do not run, e.g. inside a multiprocessing child.
+    global _bulk_pool
+    with _bulk_pool_lock:
+        pool, _bulk_pool = _bulk_pool, None
+    if pool is not None:
+        pool.shutdown()
+
+def _pipeline_worker(operations, data, filename):
+    # Runs in a pool process: decode, process and encode one upload entirely in memory.
+    # Stage timings are returned so the parent can add them to the request's.
+    timings = start_timings()
+    try:
+        data, extension = run_operations(io.BytesIO(data), operations)
+        return f"{uuid.uuid4()}.{extension}", data, timings
+    except Exception as e:
+        app.logger.warning("Could not process %s in bulk: %s", filename, e)
+        return None
+
+def _spooled_pipeline_worker(operations, file_path):
+    # Runs in a pool process: decode straight from a spooled upload and write the result
+    # next to it, so neither the upload nor the output passes through the parent.
+    timings = start_timings()
+    try:
+        data, extension = run_operations(file_path, operations)
+        output_path = f"{file_path}.{extension}"
+        with timed_stage('write'):
+            with open(output_path, 'wb') as f:
+                f.write(data)
+        return output_path, timings
     except Exception as e:
-        print(f"Error in transform_image: {e}")
+        app.logger.warning("Could not process upload %s: %s", file_path, e)
         return None
-        
-def generate_meme(form, image_file):
+
+def bulk_process_images(operations, image_files, progress=None):
+    """Run a pipeline over every upload on the process pool and zip the results."""
+    pending, pool = set(), None
     try:
-        top_text = form.get('top_text', '').upper()
-        bottom_text = form.get('bottom_text', '').upper()
-        img = Image.open(image_file.stream).convert("RGBA")
-        draw = ImageDraw.Draw(img)
-        font_path = os.path.join('static', 'impact.ttf')
-        font_size = int(img.width / 10)
-        font = ImageFont.truetype(font_path, size=font_size)
-
-        def draw_text_with_outline(text, position):
-            lines = textwrap.wrap(text, width=20)
-            if position == 'top':
-                y = 10
-            else: # bottom
-                total_text_height = sum([font.getbbox(line)[3] + 5 for line in lines])
-                y = img.height - total_text_height
-            
-            for line in lines:
-                line_width, line_height = font.getbbox(line)[2], font.getbbox(line)[3]
-                x = (img.width - line_width) / 2
-                
-                draw.text((x-2, y-2), line, font=font, fill='black')
-                draw.text((x+2, y-2), line, font=font, fill='black')
-                draw.text((x-2, y+2), line, font=font, fill='black')
-                draw.text((x+2, y+2), line, font=font, fill='black')
-                draw.text((x, y), line, font=font, fill='white')
-                
-                y += line_height + 5
-
-        if top_text:
-            draw_text_with_outline(top_text, 'top')
-        if bottom_text:
-            draw_text_with_outline(bottom_text, 'bottom')
+        zip_path = os.path.join(TEMP_DIR, f"{uuid.uuid4()}.zip")
+        pool = _get_bulk_pool()
+        with zipfile.ZipFile(zip_path, 'w') as zipf:
+            completed = 0
+            def write_results(futures):
+                nonlocal completed
+                for future in futures:
+                    result = future.result()
+                    if result:
+                        arcname, data, timings = result
+                        with timed_stage('write'):
+                            zipf.writestr(arcname, data)
+                        merge_timings(timings)
+                    completed += 1
+                if progress:
+                    progress(completed)
+            for image_file in image_files:
+                pending.add(pool.submit(_pipeline_worker, operations, image_file.read(), image_file.filename))
+                if len(pending) >= BULK_MAX_IN_FLIGHT:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    write_results(done)
+            done, pending = wait(pending)
+            write_results(done)
+        return zip_path
+    except Exception as e:
+        for future in pending:
+            future.cancel()
+        if isinstance(e, BrokenProcessPool) and pool is not None:
+            _replace_broken_bulk_pool(pool)
+        if 'zip_path' in locals() and os.path.exists(zip_path):
+            os.remove(zip_path)
+        app.logger.exception("Error in bulk_process_images")
+        return None
+
+def bulk_resize_operations(form):
+    params = {key: form.get(key) for key in form}
+    return [{**params, 'op': 'resize'},
+            {'op': 'convert', 'format': params.get('format', 'jpeg'), 'quality': params.get('quality', 85)}]
+
+def bulk_resize_images(form, image_files, progress=None):
+    return bulk_process_images(bulk_resize_operations(form), image_files, progress)
+
+
+# --- Background jobs ---
+# A bounded queue feeds a small pool of worker threads. When the queue is full,
+# submissions are rejected so the caller can retry instead of piling up work.
+JOB_WORKERS = 2
+JOB_QUEUE_SIZE = 32
+JOB_HISTORY_LIMIT = 500
+_job_queue = queue.Queue(maxsize=JOB_QUEUE_SIZE)
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
+_job_threads = []
+
+def _spool_uploads(image_files):
+    """Copy uploads into a fresh directory of closed files; returns (directory, [(path, filename)]).
+
+    Request streams are closed once the response is sent, so queued jobs keep their own
+    copy, and a queued batch holds no file descriptors however many images it has.
+    """
+    spool_dir = tempfile.mkdtemp(prefix='job-')
+    spooled = []
+    try:
+        for index, image_file in enumerate(image_files):
+            path = os.path.join(spool_dir, str(index))
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(image_file.stream, f)
+            spooled.append((path, image_file.filename))
+    except Exception:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        raise
+    return spool_dir, spooled
+
+def _open_spooled(spooled):
+    # Opens one file at a time, closing it when the consumer moves on to the next.
+    for path, filename in spooled:
+        with open(path, 'rb') as stream:
+            yield FileStorage(stream=stream, filename=filename)
+
+def _job_worker():
+    while True:
+        job, run = _job_queue.get()
+        with _jobs_lock:
+            job['status'] = 'running'
+        def progress(done):
+            with _jobs_lock:
+                job['done'] = done
+        timings = start_timings()
+        try:
+            file_path = run(progress)
+        except Exception:
+            app.logger.exception("Error in job %s", job['id'])
+            file_path = None
+        record_timings(timings)
+        with _jobs_lock:
+            job['file_path'] = file_path
+            job['timings'] = timings
+            job['status'] = 'finished' if file_path else 'failed'
+            if file_path:
+                job['done'] = job['total']
+        _job_queue.task_done()
+
+def _start_job_workers():
+    with _jobs_lock:
+        while len(_job_threads) < JOB_WORKERS:
+            thread = threading.Thread(target=_job_worker, name=f"job-worker-{len(_job_threads)}", daemon=True)
+            thread.start()
+            _job_threads.append(thread)
+
+def submit_job(run, total, error_message, stats=None):
+    """Queue run(progress) and return the job record, or None if the queue is full."""
+    _start_job_workers()
+    job = {'id': str(uuid.uuid4()), 'status': 'queued', 'done': 0, 'total': total,
+           'file_path': None, 'error': error_message, 'stats': stats}
+    with _jobs_lock:
+        _jobs[job['id']] = job
+    try:
+        _job_queue.put_nowait((job, run))
+    except queue.Full:
+        with _jobs_lock:
+            del _jobs[job['id']]
+        return None
+    with _jobs_lock:
+        finished = [job_id for job_id, j in _jobs.items() if j['status'] in ('finished', 'failed')]
+        for job_id in finished[:max(0, len(_jobs) - JOB_HISTORY_LIMIT)]:
+            del _jobs[job_id]
+    return job
+
+def get_job(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
 
-        unique_filename = f"meme-{uuid.uuid4()}.jpg"
-        save_path = os.path.join('temp', unique_filename)
-        img = img.convert('RGB')
-        img.save(save_path, 'JPEG')
-        return save_path
 
+# --- Result cache ---
+# Re-submitting the same image with the same settings reuses the earlier output
+# in temp/. Keys hash the upload bytes with the parameters the tool actually
+# reads, exactly as sent since the tools compare them case-sensitively; entries
+# are evicted least-recently-used once the cached files exceed
+# RESULT_CACHE_MAX_BYTES.
+RESULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+RESULT_CACHE_PARAMS = {
+    'resize_by_dimension': ('unit', 'width', 'height', 'dpi', 'format', 'quality', 'aspect_ratio', 'transform', 'fast_downscale'),
+    'reduce_by_filesize': ('target_size', 'size_unit', 'format'),
+    'crop_image': ('crop_x', 'crop_y', 'crop_width', 'crop_height'),
+    'convert_image': ('format',),
+    'transform_image': ('operation',),
+    'process_pipeline': ('operations',),
+}
+_result_cache = OrderedDict()
+_result_cache_bytes = 0
+_result_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+_result_cache_lock = threading.Lock()
+
+def _normalize_param(key, value):
+    # Only a pipeline is parsed, as parse_operations would; whitespace in its JSON does not matter.
+    if key == 'operations':
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+def result_cache_key(func, form, image_file):
+    """Hash the upload and the parameters func depends on, or None if func is not cacheable."""
+    keys = RESULT_CACHE_PARAMS.get(func.__name__)
+    if keys is None:
+        return None
+    params = {key: _normalize_param(key, form.get(key)) for key in keys if form.get(key) is not None}
+    if params.get('unit') not in ('cm', 'mm'):
+        params.pop('dpi', None)
+    if params.get('format', 'jpeg') not in ('jpeg', 'webp'):
+        params.pop('quality', None)
+    digest = hashlib.sha256(json.dumps([func.__name__, params], sort_keys=True).encode())
+    for chunk in iter(lambda: image_file.stream.read(65536), b''):
+        digest.update(chunk)
+    image_file.stream.seek(0)
+    return digest.hexdigest()
+
+def result_cache_get(key):
+    """Return (file_path, stats) for a cached result, or None."""
+    global _result_cache_bytes
+    with _result_cache_lock:
+        entry = _result_cache.get(key)
+        if entry and not os.path.exists(entry[0]):
+            del _result_cache[key]
+            _result_cache_bytes -= entry[1]
+            entry = None
+        if entry is None:
+            _result_cache_stats['misses'] += 1
+            return None
+        _result_cache.move_to_end(key)
+        _result_cache_stats['hits'] += 1
+    touch_temp_file(entry[0])
+    return entry[0], entry[2]
+
+def result_cache_put(key, file_path, stats=None):
+    global _result_cache_bytes
+    size = os.path.getsize(file_path)
+    evicted = []
+    with _result_cache_lock:
+        if key in _result_cache:
+            return
+        _result_cache[key] = (file_path, size, dict(stats) if stats else None)
+        _result_cache_bytes += size
+        while _result_cache_bytes > RESULT_CACHE_MAX_BYTES and len(_result_cache) > 1:
+            _, (old_path, old_size, _) = _result_cache.popitem(last=False)
+            _result_cache_bytes -= old_size
+            _result_cache_stats['evictions'] += 1
+            evicted.append(old_path)
+    for old_path in evicted:
+        _remove_temp_file(old_path, 'evicted')
+
+def result_cache_discard(file_path):
+    global _result_cache_bytes
+    with _result_cache_lock:
+        for key, entry in list(_result_cache.items()):
+            if entry[0] == file_path:
+                del _result_cache[key]
+                _result_cache_bytes -= entry[1]
+
+def result_cache_info():
+    with _result_cache_lock:
+        return {**_result_cache_stats, 'entries': len(_result_cache), 'bytes': _result_cache_bytes}
+
+
+# --- Output store ---
+# Files in TEMP_DIR expire TEMP_TTL_SECONDS after they were last written or
+# reused, and the oldest are evicted once the directory, counting the spooled
+# uploads under UPLOAD_DIR, exceeds TEMP_MAX_BYTES.
+# A background thread sweeps every TEMP_SWEEP_INTERVAL seconds.
+TEMP_TTL_SECONDS = 60 * 60
+TEMP_MAX_BYTES = 1024 * 1024 * 1024
+TEMP_SWEEP_INTERVAL = 60
+TEMP_DELETE_AFTER_DOWNLOAD = False
+TEMP_EXPIRED_HISTORY = 10000
+_temp_stats = {'expired': 0, 'evicted': 0, 'downloaded': 0}
+_expired_files = OrderedDict()
+_temp_lock = threading.Lock()
+_temp_sweeper = None
+
+def _remove_temp_file(file_path, reason):
+    try:
+        os.remove(file_path)
+    except OSError:
+        return
+    result_cache_discard(file_path)
+    with _temp_lock:
+        _temp_stats[reason] += 1
+        _expired_files[os.path.basename(file_path)] = reason
+        while len(_expired_files) > TEMP_EXPIRED_HISTORY:
+            _expired_files.popitem(last=False)
+
+def _is_stale(file_path, now=None):
+    try:
+        return (now or time.time()) - os.path.getmtime(file_path) > TEMP_TTL_SECONDS
+    except OSError:
+        return False
+
+def touch_temp_file(file_path):
+    # Reused outputs (e.g. cache hits) get a fresh lifetime.
+    try:
+        os.utime(file_path)
+    except OSError:
+        pass
+
+def sweep_temp():
+    """Delete expired files, then the oldest ones until the store fits its quota."""
+    now = time.time()
+    entries = []
+    with os.scandir(TEMP_DIR) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if now - stat.st_mtime > TEMP_TTL_SECONDS:
+                _remove_temp_file(entry.path, 'expired')
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_bytes = sum(size for _, size, _ in entries) + upload_spool_bytes()
+    for _, size, file_path in sorted(entries):
+        if total_bytes <= TEMP_MAX_BYTES:
+            break
+        _remove_temp_file(file_path, 'evicted')
+        total_bytes -= size
+
+def _temp_sweeper_loop():
+    while True:
+        try:
+            sweep_temp()
+            sweep_uploads()
+        except Exception:
+            app.logger.exception("Error in sweep_temp")
+        time.sleep(TEMP_SWEEP_INTERVAL)
+
+def start_temp_sweeper():
+    global _temp_sweeper
+    with _temp_lock:
+        if _temp_sweeper is None:
+            _temp_sweeper = threading.Thread(target=_temp_sweeper_loop, name='temp-sweeper', daemon=True)
+            _temp_sweeper.start()
+
+def temp_store_info():
+    files, total_bytes = 0, 0
+    with os.scandir(TEMP_DIR) as it:
+        for entry in it:
+            if entry.is_file():
+                files += 1
+                total_bytes += entry.stat().st_size
+    with _uploads_lock:
+        sessions = len(_uploads)
+    with _temp_lock:
+        return {**_temp_stats, 'files': files, 'bytes': total_bytes,
+                'upload_sessions': sessions, 'upload_bytes': upload_spool_bytes()}
+
+
+# --- Upload sessions ---
+# Large files and big batches can be sent in chunks instead of one multipart request:
+#   POST /uploads                           files=[{"name": ..., "size": ...}] plus either
+#                                           operations (a pipeline) or the bulk resize fields
+#   PUT  /uploads/<id>/files/<n>?offset=N   raw bytes of file n, starting at byte N
+#   GET  /uploads/<id>                      bytes received per file, to resume after a failure
+#   POST /uploads/<id>/finalize             queues a job that collects the results
+# Chunks are streamed to UPLOAD_DIR and every file goes to the bulk pool as soon as its
+# last byte arrives, so processing overlaps the rest of the upload. One file gives a
+# single result, several give a .zip. Sessions idle for UPLOAD_TTL_SECONDS are swept.
+# At most UPLOAD_MAX_SESSIONS sessions may be open, declaring UPLOAD_MAX_BYTES between them.
+UPLOAD_DIR = os.path.join(TEMP_DIR, 'uploads')
+UPLOAD_MAX_SESSIONS = 16
+UPLOAD_MAX_BYTES = TEMP_MAX_BYTES
+UPLOAD_MAX_FILES = 500
+UPLOAD_MAX_FILE_BYTES = 200 * 1024 * 1024
+UPLOAD_COPY_BUFFER = 1024 * 1024
+UPLOAD_TTL_SECONDS = 60 * 60
+_uploads = {}
+_uploads_lock = threading.Lock()
+
+def create_upload(operations, files):
+    """Start a session for files, a list of {'name', 'size'}; raises ValueError.
+
+    Returns None when the open sessions leave no room for it, so the caller can retry later.
+    """
+    if not isinstance(files, list) or not 0 < len(files) <= UPLOAD_MAX_FILES:
+        raise ValueError(f"files must list between 1 and {UPLOAD_MAX_FILES} files")
+    entries = []
+    for index, file in enumerate(files):
+        size = file.get('size') if isinstance(file, dict) else None
+        if not isinstance(size, int) or not 0 < size <= UPLOAD_MAX_FILE_BYTES:
+            raise ValueError(f"file {index}: size must be between 1 and {UPLOAD_MAX_FILE_BYTES} bytes")
+        entries.append({'name': str(file.get('name') or index), 'size': size, 'received': 0,
+                        'busy': False, 'future': None})
+    declared = sum(entry['size'] for entry in entries)
+    if declared > UPLOAD_MAX_BYTES:
+        raise ValueError(f"files must total at most {UPLOAD_MAX_BYTES} bytes")
+    upload = {'id': uuid.uuid4().hex, 'operations': operations, 'files': entries, 'bytes': declared,
+              'status': 'uploading', 'updated': time.time()}
+    upload['dir'] = os.path.join(UPLOAD_DIR, upload['id'])
+    with _uploads_lock:
+        if (len(_uploads) >= UPLOAD_MAX_SESSIONS
+                or sum(other['bytes'] for other in _uploads.values()) + declared > UPLOAD_MAX_BYTES):
+            return None
+        _uploads[upload['id']] = upload
+    try:
+        os.makedirs(upload['dir'])
+    except OSError:
+        discard_upload(upload['id'])
+        raise
+    return upload
+
+def upload_spool_bytes():
+    total_bytes = 0
+    for root, _, names in os.walk(UPLOAD_DIR):
+        for name in names:
+            try:
+                total_bytes += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total_bytes
+
+def get_upload(upload_id):
+    with _uploads_lock:
+        return _uploads.get(upload_id)
+
+def discard_upload(upload_id):
+    with _uploads_lock:
+        _uploads.pop(upload_id, None)
+    shutil.rmtree(os.path.join(UPLOAD_DIR, os.path.basename(upload_id)), ignore_errors=True)
+
+def upload_info(upload):
+    with _uploads_lock:
+        files = [{'index': index, 'name': entry['name'], 'size': entry['size'], 'received': entry['received'],
+                  'processed': bool(entry['future'] and entry['future'].done())}
+                 for index, entry in enumerate(upload['files'])]
+        return {'upload_id': upload['id'], 'status': upload['status'], 'files': files}
+
+def _submit_upload_file(upload, index, pool=None):
+    return (pool or _get_bulk_pool()).submit(_spooled_pipeline_worker, upload['operations'], os.path.join(upload['dir'], str(index)))
+
+def write_chunk(upload, index, offset, stream, length):
+    """Copy length bytes from stream into file index at offset. Returns (accepted, received).
+
+    A chunk is refused unless offset is exactly where the file left off and no other
+    chunk for it is in flight; the client then resumes from received. Whatever arrived
+    before a dropped connection is kept. Raises ValueError for chunks that cannot fit.
+    """
+    if not 0 <= index < len(upload['files']):
+        raise ValueError(f"no file {index} in this upload")
+    entry = upload['files'][index]
+    with _uploads_lock:
+        if upload['status'] != 'uploading' or entry['busy'] or offset != entry['received']:
+            return False, entry['received']
+        if offset + length > entry['size']:
+            raise ValueError(f"chunk ends past the declared size of {entry['size']} bytes")
+        entry['busy'] = True
+    written = 0
+    try:
+        with open(os.path.join(upload['dir'], str(index)), 'ab') as f:
+            while written < length:
+                data = stream.read(min(UPLOAD_COPY_BUFFER, length - written))
+                if not data:
+                    break
+                f.write(data)
+                written += len(data)
+    finally:
+        with _uploads_lock:
+            entry['received'] += written
+            entry['busy'] = False
+            upload['updated'] = time.time()
+            if written and entry['received'] == entry['size']:
+                try:
+                    entry['future'] = _submit_upload_file(upload, index)
+                except Exception:
+                    # finalize_upload submits anything that is still missing.
+                    app.logger.exception("Could not queue upload %s file %s", upload['id'], index)
+    return True, entry['received']
+
+def _failed_future(future):
+    return future.done() and (future.cancelled() or future.exception() is not None)
+
+def finalize_upload(upload, progress=None):
+    """Wait for every file's result and return the output path; the session is then removed.
+
+    If processing breaks (e.g. a pool worker dies) the session goes back to 'uploading'
+    with its files kept, so the client can finalize again without resending anything.
+    """
+    with _uploads_lock:
+        if upload['status'] != 'uploading':
+            return None
+        upload['status'] = 'finalizing'
+    pool = _get_bulk_pool()
+    try:
+        with _uploads_lock:
+            for index, entry in enumerate(upload['files']):
+                if entry['future'] is None:
+                    entry['future'] = _submit_upload_file(upload, index, pool)
+            pending = {entry['future'] for entry in upload['files']}
+        total, results = len(pending), []
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if result:
+                    output_path, timings = result
+                    merge_timings(timings)
+                    results.append(output_path)
+            if progress:
+                progress(total - len(pending))
+        if len(upload['files']) == 1:
+            if not results:
+                discard_upload(upload['id'])
+                return None
+            file_path = os.path.join(TEMP_DIR, f"upload-{uuid.uuid4()}{os.path.splitext(results[0])[1]}")
+            os.replace(results[0], file_path)
+        else:
+            file_path = os.path.join(TEMP_DIR, f"{uuid.uuid4()}.zip")
+            with timed_stage('write'):
+                with zipfile.ZipFile(file_path, 'w') as zipf:
+                    for output_path in results:
+                        zipf.write(output_path, f"{uuid.uuid4()}{os.path.splitext(output_path)[1]}")
     except Exception as e:
-        print(f"CRITICAL ERROR in generate_meme: {e}")
+        if isinstance(e, BrokenProcessPool):
+            _replace_broken_bulk_pool(pool)
+        app.logger.exception("Error in finalize_upload")
+        with _uploads_lock:
+            for entry in upload['files']:
+                if entry['future'] is not None and _failed_future(entry['future']):
+                    entry['future'] = None
+            upload['status'] = 'uploading'
+            upload['updated'] = time.time()
         return None
+    discard_upload(upload['id'])
+    return file_path
+
+def sweep_uploads():
+    """Remove sessions that stopped receiving chunks, and spool directories left by a restart."""
+    now = time.time()
+    if not os.path.isdir(UPLOAD_DIR):
+        return
+    with os.scandir(UPLOAD_DIR) as it:
+        for entry in it:
+            upload = get_upload(entry.name)
+            if upload:
+                stale = upload['status'] == 'uploading' and now - upload['updated'] > UPLOAD_TTL_SECONDS
+            else:
+                stale = now - entry.stat().st_mtime > UPLOAD_TTL_SECONDS
+            if stale:
+                discard_upload(entry.name)
 
 
 # --- Main Routes ---
+def _result_response(file_path, error_message, stats=None):
+    if file_path:
+        download_url = url_for('serve_temp_file', filename=os.path.basename(file_path))
+        return jsonify({**(stats or {}), 'success': True, 'download_url': download_url})
+    else: return jsonify({'error': error_message}), 500
+
+def _busy_response():
+    return jsonify({'error': 'The server is busy, please try again shortly.'}), 503, {'Retry-After': '5'}
+
+def _job_response(run, total, error_message, stats=None, spool_dir=None):
+    # The job's spooled uploads are deleted once it is done or turned away.
+    def run_and_clean_up(progress):
+        try:
+            return run(progress)
+        finally:
+            if spool_dir:
+                shutil.rmtree(spool_dir, ignore_errors=True)
+    job = submit_job(run_and_clean_up, total, error_message, stats)
+    if not job:
+        if spool_dir:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+        return _busy_response()
+    status_url = url_for('job_status', job_id=job['id'])
+    return jsonify({'success': True, 'job_id': job['id'], 'status_url': status_url}), 202, {'Location': status_url}
+
+def _cached_run(func, key, form, image_file, kwargs):
+    file_path = func(form, image_file, **kwargs)
+    if file_path and key:
+        result_cache_put(key, file_path, kwargs.get('stats'))
+    return file_path
+
+def _with_result_headers(response, stats):
+    for key, value in (stats or {}).items():
+        response.headers[f"X-Result-{key.replace('_', '-').title()}"] = str(value)
+    return response
+
+def _persist_result(key, data, filename, stats):
+    try:
+        result_cache_put(key, _write_output(data, filename), stats)
+    except Exception:
+        app.logger.exception("Error caching a direct result")
+
+def _direct_response(func, image_file, error_message, stats=None, key=None):
+    # Encodes into memory and returns the image itself, skipping TEMP_DIR and the follow-up GET.
+    # Cacheable results are written to TEMP_DIR only once the response has been sent, so a
+    # resubmission is a cache hit without a disk write on this request's path.
+    out = io.BytesIO()
+    kwargs = {'out': out} if stats is None else {'out': out, 'stats': stats}
+    filename = func(request.form, image_file, **kwargs)
+    if not filename: return jsonify({'error': error_message}), 500
+    data = out.getvalue()
+    out.seek(0)
+    response = send_file(out, as_attachment=True, download_name=filename)
+    response.content_length = len(data)
+    if key:
+        # Passthrough responses skip close callbacks, so stream through the response instead.
+        response.direct_passthrough = False
+        response.call_on_close(lambda: _persist_result(key, data, filename, stats))
+    return _with_result_headers(response, stats)
+
+def _bulk_response(func, params, image_files, error_message):
+    # func(params, uploads, progress) zips its results; queued when the client sends async=1.
+    if request.form.get('async'):
+        if _job_queue.full(): return _busy_response()
+        spool_dir, spooled = _spool_uploads(image_files)
+        return _job_response(lambda progress: func(params, _open_spooled(spooled), progress), len(spooled),
+                             error_message, spool_dir=spool_dir)
+    return _result_response(func(params, image_files), error_message)
+
+def _tool_response(func, image_file, error_message, stats=None):
+    # Runs a single-image tool inline, or queues it when the client sends async=1.
+    # Tools that report extra details take a stats dict, which is merged into the response.
+    # delivery=direct (form field or query string) returns the image bytes in this response.
+    # A cache hit answers straight away with the earlier result, even for async=1.
+    direct = request.values.get('delivery') == 'direct'
+    key = result_cache_key(func, request.form, image_file)
+    cached = result_cache_get(key) if key else None
+    if cached and direct:
+        return _with_result_headers(send_file(cached[0], as_attachment=True), {**(cached[1] or {}), 'cached': True})
+    if cached:
+        return _result_response(cached[0], error_message, {**(cached[1] or {}), 'cached': True})
+    if direct:
+        return _direct_response(func, image_file, error_message, stats, key)
+    kwargs = {} if stats is None else {'stats': stats}
+    if request.form.get('async'):
+        if _job_queue.full(): return _busy_response()
+        form, (spool_dir, spooled) = request.form.copy(), _spool_uploads([image_file])
+        def run(progress):
+            path, filename = spooled[0]
+            with open(path, 'rb') as stream:
+                return _cached_run(func, key, form, FileStorage(stream=stream, filename=filename), kwargs)
+        return _job_response(run, 1, error_message, stats, spool_dir)
+    return _result_response(_cached_run(func, key, request.form, image_file, kwargs), error_message, stats)
+
+@app.before_request
+def ensure_temp_sweeper():
+    start_temp_sweeper()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    start_timings()
+
+@app.after_request
+def add_timing_headers(response):
+    # Server-Timing shows the per-stage breakdown in browser dev tools.
+    elapsed = time.perf_counter() - g.request_start
+    timings = current_timings() or {}
+    if timings:
+        response.headers['Server-Timing'] = ', '.join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+        record_timings(timings)
+    if request.endpoint not in ('metrics', 'static'):
+        observe('http_request_duration_seconds', 'endpoint', request.endpoint or 'unknown', elapsed)
+    return response
+
 @app.route('/temp/<filename>')
 def serve_temp_file(filename):
-    return send_file(os.path.join('temp', filename), as_attachment=True)
+    file_path = os.path.join(TEMP_DIR, filename)
+    if _is_stale(file_path):
+        _remove_temp_file(file_path, 'expired')
+    if not os.path.isfile(file_path):
+        with _temp_lock:
+            expired = filename in _expired_files
+        if expired: return jsonify({'error': 'This file has expired. Please process the image again.'}), 410
+        return jsonify({'error': 'File not found.'}), 404
+    response = send_file(file_path, as_attachment=True)
+    if TEMP_DELETE_AFTER_DOWNLOAD:
+        # Passthrough responses skip close callbacks, so stream through the response instead.
+        response.direct_passthrough = False
+        response.call_on_close(lambda: _remove_temp_file(file_path, 'downloaded'))
+    return response
 
 @app.route('/')
 def index():
@@ -220,11 +1254,7 @@ def crop_page():
     if request.method == 'POST':
         image_file = request.files.get('image')
         if not image_file: return jsonify({'error': 'No image file uploaded!'}), 400
-        file_path = crop_image(request.form, image_file)
-        if file_path:
-            download_url = url_for('serve_temp_file', filename=os.path.basename(file_path))
-            return jsonify({'success': True, 'download_url': download_url})
-        else: return jsonify({'error': 'An error occurred during cropping.'}), 500
+        return _tool_response(crop_image, image_file, 'An error occurred during cropping.')
     return render_template('crop.html')
 
 @app.route('/bulk-resize', methods=['GET', 'POST'])
@@ -232,11 +1262,11 @@ def bulk_resize_page():
     if request.method == 'POST':
         image_files = request.files.getlist('images[]')
         if not image_files: return jsonify({'error': 'No image files uploaded!'}), 400
-        file_path = bulk_resize_images(request.form, image_files)
-        if file_path:
-            download_url = url_for('serve_temp_file', filename=os.path.basename(file_path))
-            return jsonify({'success': True, 'download_url': download_url})
-        else: return jsonify({'error': 'An error occurred during bulk processing.'}), 500
+        try:
+            operations = parse_operations(bulk_resize_operations(request.form))
+        except ValueError as e:
+            return jsonify({'error': f"Invalid settings: {e}"}), 400
+        return _bulk_response(bulk_process_images, operations, image_files, 'An error occurred during bulk processing.')
     return render_template('bulk-resize.html')
 
 @app.route('/convert', methods=['GET', 'POST'])
@@ -244,11 +1274,7 @@ def convert_page():
     if request.method == 'POST':
         image_file = request.files.get('image')
         if not image_file: return jsonify({'error': 'No image file uploaded!'}), 400
-        file_path = convert_image(request.form, image_file)
-        if file_path:
-            download_url = url_for('serve_temp_file', filename=os.path.basename(file_path))
-            return jsonify({'success': True, 'download_url': download_url})
-        else: return jsonify({'error': 'An error occurred during conversion.'}), 500
+        return _tool_response(convert_image, image_file, 'An error occurred during conversion.')
     return render_template('convert.html')
 
 @app.route('/transform', methods=['GET', 'POST'])
@@ -256,11 +1282,7 @@ def transform_page():
     if request.method == 'POST':
         image_file = request.files.get('image')
         if not image_file: return jsonify({'error': 'No image file uploaded!'}), 400
-        file_path = transform_image(request.form, image_file)
-        if file_path:
-            download_url = url_for('serve_temp_file', filename=os.path.basename(file_path))
-            return jsonify({'success': True, 'download_url': download_url})
-        else: return jsonify({'error': 'An error occurred during transformation.'}), 500
+        return _tool_response(transform_image, image_file, 'An error occurred during transformation.')
     return render_template('transform.html')
 
 @app.route('/meme', methods=['GET', 'POST'])
@@ -268,11 +1290,7 @@ def meme_page():
     if request.method == 'POST':
         image_file = request.files.get('image')
         if not image_file: return jsonify({'error': 'No image file uploaded!'}), 400
-        file_path = generate_meme(request.form, image_file)
-        if file_path:
-            download_url = url_for('serve_temp_file', filename=os.path.basename(file_path))
-            return jsonify({'success': True, 'download_url': download_url})
-        else: return jsonify({'error': 'An error occurred during meme generation.'}), 500
+        return _tool_response(generate_meme, image_file, 'An error occurred during meme generation.')
     return render_template('meme.html')
 
 @app.route('/process', methods=['POST'])
@@ -280,14 +1298,97 @@ def process_image():
     image_file = request.files.get('image')
     if not image_file: return jsonify({'error': 'No image file selected!'}), 400
     mode = request.form.get('mode')
-    file_path = None
-    if mode == 'dimension': file_path = resize_by_dimension(request.form, image_file)
-    elif mode == 'filesize': file_path = reduce_by_filesize(request.form, image_file)
-    if file_path:
-        download_url = url_for('serve_temp_file', filename=os.path.basename(file_path))
-        return jsonify({'success': True, 'download_url': download_url})
-    else: return jsonify({'error': 'An error occurred during processing.'}), 500
+    error_message = 'An error occurred during processing.'
+    if mode == 'dimension': return _tool_response(resize_by_dimension, image_file, error_message)
+    elif mode == 'filesize':
+        try:
+            _target_bytes(request.form)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Target size must be a positive whole number.'}), 400
+        return _tool_response(reduce_by_filesize, image_file, error_message, stats={})
+    return jsonify({'error': error_message}), 500
+
+@app.route('/metrics')
+def metrics():
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+@app.route('/store/stats')
+def store_stats():
+    return jsonify(temp_store_info())
+
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify(result_cache_info())
+
+@app.route('/pipeline', methods=['POST'])
+def pipeline_page():
+    # One image in 'image' returns a single result; several in 'images[]' return a .zip.
+    try:
+        operations = parse_operations(request.form.get('operations', ''))
+    except ValueError as e:
+        return jsonify({'error': f"Invalid operations: {e}"}), 400
+    error_message = 'An error occurred while running the pipeline.'
+    image_files = request.files.getlist('images[]')
+    if image_files:
+        return _bulk_response(bulk_process_images, operations, image_files, error_message)
+    image_file = request.files.get('image')
+    if not image_file: return jsonify({'error': 'No image file uploaded!'}), 400
+    return _tool_response(process_pipeline, image_file, error_message, stats={})
+
+@app.route('/uploads', methods=['POST'])
+def create_upload_page():
+    # Send operations for a pipeline; otherwise the bulk resize fields are used.
+    try:
+        form = request.form
+        operations = parse_operations(form['operations'] if 'operations' in form else bulk_resize_operations(form))
+        upload = create_upload(operations, json.loads(form.get('files', '')))
+    except ValueError as e:
+        return jsonify({'error': f"Invalid upload: {e}"}), 400
+    if not upload: return _busy_response()
+    status_url = url_for('upload_status', upload_id=upload['id'])
+    return jsonify({**upload_info(upload), 'status_url': status_url}), 201, {'Location': status_url}
+
+@app.route('/uploads/<upload_id>')
+def upload_status(upload_id):
+    upload = get_upload(upload_id)
+    if not upload: return jsonify({'error': 'Unknown or expired upload.'}), 404
+    return jsonify(upload_info(upload))
+
+@app.route('/uploads/<upload_id>/files/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    upload = get_upload(upload_id)
+    if not upload: return jsonify({'error': 'Unknown or expired upload.'}), 404
+    offset = request.args.get('offset', type=int)
+    if offset is None or request.content_length is None:
+        return jsonify({'error': 'An offset and a Content-Length are required.'}), 400
+    try:
+        accepted, received = write_chunk(upload, index, offset, request.stream, request.content_length)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'index': index, 'received': received}), 200 if accepted else 409
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload_page(upload_id):
+    upload = get_upload(upload_id)
+    if not upload: return jsonify({'error': 'Unknown or expired upload.'}), 404
+    incomplete = [file['index'] for file in upload_info(upload)['files'] if file['received'] < file['size']]
+    if incomplete: return jsonify({'error': 'Some files have not been fully uploaded.', 'incomplete': incomplete}), 409
+    return _job_response(lambda progress: finalize_upload(upload, progress), len(upload['files']),
+                         'An error occurred while processing the upload.')
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = get_job(job_id)
+    if not job: return jsonify({'error': 'Unknown job.'}), 404
+    result = {'job_id': job['id'], 'status': job['status'], 'done': job['done'], 'total': job['total']}
+    if job.get('timings'):
+        result['timings'] = {stage: round(seconds * 1000, 1) for stage, seconds in job['timings'].items()}
+    if job['status'] == 'finished':
+        result.update(job['stats'] or {})
+        result['download_url'] = url_for('serve_temp_file', filename=os.path.basename(job['file_path']))
+    elif job['status'] == 'failed':
+        result['error'] = job['error']
+    return jsonify(result)
 
 if __name__ == '__main__':
-    if not os.path.exists('temp'): os.makedirs('temp')
     app.run(debug=True)
\ No newline at end of file
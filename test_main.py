@@ -0,0 +1,234 @@
+import io
+import json
+import os
+import time
+import zipfile
+
+import pytest
+from PIL import Image
+from werkzeug.datastructures import FileStorage, MultiDict
+
+import main
+
+RESIZE_FIELDS = {'unit': 'px', 'width': '40', 'height': '40', 'format': 'jpeg', 'aspect_ratio': 'true'}
+
+
+def jpeg_bytes(width=120, height=80):
+    img_io = io.BytesIO()
+    Image.linear_gradient('L').resize((width, height)).convert('RGB').save(img_io, 'JPEG')
+    return img_io.getvalue()
+
+
+@pytest.fixture(scope='module', autouse=True)
+def bulk_pool():
+    yield
+    main.shutdown_bulk_pool()
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'TEMP_DIR', str(tmp_path))
+    monkeypatch.setattr(main, 'UPLOAD_DIR', str(tmp_path / 'uploads'))
+    yield main.app.test_client()
+    for upload_id in list(main._uploads):
+        main.discard_upload(upload_id)
+
+
+def create_upload(client, sizes, **fields):
+    files = [{'name': f"{index}.jpg", 'size': size} for index, size in enumerate(sizes)]
+    return client.post('/uploads', data={**RESIZE_FIELDS, **fields, 'files': json.dumps(files)})
+
+
+def put_chunk(client, upload_id, index, offset, data):
+    return client.put(f"/uploads/{upload_id}/files/{index}?offset={offset}", data=data,
+                      content_type='application/octet-stream')
+
+
+def wait_for_job(client, response):
+    assert response.status_code == 202
+    for _ in range(300):
+        job = client.get(response.get_json()['status_url']).get_json()
+        if job['status'] in ('finished', 'failed'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError('job did not finish')
+
+
+def download(client, job):
+    return client.get(job['download_url']).data
+
+
+# --- Upload sessions ---
+
+def test_interrupted_file_resumes_from_reported_offset(client):
+    data = jpeg_bytes()
+    upload_id = create_upload(client, [len(data)]).get_json()['upload_id']
+    assert put_chunk(client, upload_id, 0, 0, data[:100]).get_json() == {'index': 0, 'received': 100}
+
+    status = client.get(f"/uploads/{upload_id}").get_json()
+    received = status['files'][0]['received']
+    assert put_chunk(client, upload_id, 0, received, data[received:]).status_code == 200
+
+    job = wait_for_job(client, client.post(f"/uploads/{upload_id}/finalize"))
+    assert job['status'] == 'finished'
+    assert Image.open(io.BytesIO(download(client, job))).size == (40, 27)
+
+
+def test_duplicate_and_out_of_order_chunks_are_refused(client):
+    data = jpeg_bytes()
+    upload_id = create_upload(client, [len(data)]).get_json()['upload_id']
+    put_chunk(client, upload_id, 0, 0, data[:100])
+
+    duplicate = put_chunk(client, upload_id, 0, 0, data[:100])
+    ahead = put_chunk(client, upload_id, 0, 200, data[200:300])
+    assert (duplicate.status_code, duplicate.get_json()['received']) == (409, 100)
+    assert (ahead.status_code, ahead.get_json()['received']) == (409, 100)
+    assert client.get(f"/uploads/{upload_id}").get_json()['files'][0]['received'] == 100
+
+
+def test_chunk_past_declared_size_is_rejected(client):
+    upload_id = create_upload(client, [10]).get_json()['upload_id']
+    assert put_chunk(client, upload_id, 0, 0, b'x' * 11).status_code == 400
+    assert put_chunk(client, upload_id, 1, 0, b'x').status_code == 400
+    assert client.get(f"/uploads/{upload_id}").get_json()['files'][0]['received'] == 0
+
+
+def test_finalize_with_incomplete_files_is_refused(client):
+    data = jpeg_bytes()
+    upload_id = create_upload(client, [len(data), len(data)]).get_json()['upload_id']
+    put_chunk(client, upload_id, 0, 0, data)
+    put_chunk(client, upload_id, 1, 0, data[:10])
+
+    response = client.post(f"/uploads/{upload_id}/finalize")
+    assert response.status_code == 409
+    assert response.get_json()['incomplete'] == [1]
+
+
+def test_files_are_processed_as_soon_as_they_complete(client):
+    data = jpeg_bytes()
+    upload_id = create_upload(client, [len(data), len(data)]).get_json()['upload_id']
+    put_chunk(client, upload_id, 0, 0, data)
+    for _ in range(300):
+        files = client.get(f"/uploads/{upload_id}").get_json()['files']
+        if files[0]['processed']:
+            break
+        time.sleep(0.05)
+    assert [file['processed'] for file in files] == [True, False]
+
+
+def test_several_files_give_a_zip(client):
+    data = jpeg_bytes()
+    upload_id = create_upload(client, [len(data)] * 3).get_json()['upload_id']
+    for index in range(3):
+        put_chunk(client, upload_id, index, 0, data)
+
+    job = wait_for_job(client, client.post(f"/uploads/{upload_id}/finalize"))
+    assert job['download_url'].endswith('.zip')
+    names = zipfile.ZipFile(io.BytesIO(download(client, job))).namelist()
+    assert len(names) == 3 and all(name.endswith('.jpeg') for name in names)
+    assert client.get(f"/uploads/{upload_id}").status_code == 404
+
+
+def test_one_file_pipeline_gives_the_image(client):
+    data = jpeg_bytes()
+    operations = json.dumps([{'op': 'transpose', 'operation': 'rotate_90'}, {'op': 'convert', 'format': 'png'}])
+    files = json.dumps([{'name': 'a.jpg', 'size': len(data)}])
+    upload_id = client.post('/uploads', data={'files': files, 'operations': operations}).get_json()['upload_id']
+    put_chunk(client, upload_id, 0, 0, data)
+
+    job = wait_for_job(client, client.post(f"/uploads/{upload_id}/finalize"))
+    result = Image.open(io.BytesIO(download(client, job)))
+    assert (result.format, result.size) == ('PNG', (80, 120))
+
+
+def test_finalize_keeps_the_session_when_the_pool_breaks(client):
+    data = jpeg_bytes()
+    pool = main._get_bulk_pool()
+    with pytest.raises(Exception):
+        pool.submit(os._exit, 1).result()
+    upload_id = create_upload(client, [len(data)]).get_json()['upload_id']
+    put_chunk(client, upload_id, 0, 0, data)
+
+    assert wait_for_job(client, client.post(f"/uploads/{upload_id}/finalize"))['status'] == 'failed'
+    status = client.get(f"/uploads/{upload_id}").get_json()
+    assert status['status'] == 'uploading' and status['files'][0]['received'] == len(data)
+
+    assert wait_for_job(client, client.post(f"/uploads/{upload_id}/finalize"))['status'] == 'finished'
+
+
+def test_session_count_and_declared_bytes_are_capped(client, monkeypatch):
+    monkeypatch.setattr(main, 'UPLOAD_MAX_SESSIONS', 2)
+    monkeypatch.setattr(main, 'UPLOAD_MAX_BYTES', 100)
+    assert create_upload(client, [101]).status_code == 400
+    assert create_upload(client, [60]).status_code == 201
+    assert create_upload(client, [60]).status_code == 503
+    assert create_upload(client, [40]).status_code == 201
+    assert create_upload(client, [1]).status_code == 503
+
+
+def test_sweep_removes_idle_sessions_and_orphaned_spools(client):
+    idle_id = create_upload(client, [10]).get_json()['upload_id']
+    active_id = create_upload(client, [10]).get_json()['upload_id']
+    main.get_upload(idle_id)['updated'] -= main.UPLOAD_TTL_SECONDS + 1
+    orphan = os.path.join(main.UPLOAD_DIR, 'left-by-a-restart')
+    os.makedirs(orphan)
+    old = time.time() - main.UPLOAD_TTL_SECONDS - 1
+    os.utime(orphan, (old, old))
+
+    main.sweep_uploads()
+    assert main.get_upload(idle_id) is None and main.get_upload(active_id)
+    assert sorted(os.listdir(main.UPLOAD_DIR)) == [active_id]
+
+
+# --- Pipelines ---
+
+@pytest.mark.parametrize('operations, message', [
+    ([{'op': 'transpose', 'operation': 'rotate_45'}], "unknown transform 'rotate_45'"),
+    ([{'op': 'resize', 'width': 'abc', 'height': 10}], 'width must be a number'),
+    ([{'op': 'crop', 'crop_x': 0, 'crop_y': 0, 'crop_width': 0, 'crop_height': 5}], 'at least one pixel'),
+    ([{'op': 'filesize', 'target_size': -5}], 'target_size must be positive'),
+    ([{'op': 'convert', 'format': 'gif'}], 'format must be one of'),
+    ([{'op': 'convert', 'format': 'png'}, {'op': 'transpose', 'operation': 'rotate_90'}], 'must be the last operation'),
+    ([{'op': 'blur'}], "unknown op 'blur'"),
+    ([], 'non-empty JSON list'),
+])
+def test_parse_operations_rejects_invalid_fields(operations, message):
+    with pytest.raises(ValueError, match=message):
+        main.parse_operations(json.dumps(operations))
+
+
+def test_invalid_pipeline_is_a_bad_request(client):
+    operations = json.dumps([{'op': 'transpose', 'operation': 'rotate_45'}])
+    response = client.post('/pipeline', data={'operations': operations, 'images[]': [(io.BytesIO(jpeg_bytes()), 'a.jpg')]},
+                           content_type='multipart/form-data')
+    assert response.status_code == 400
+
+
+def test_invalid_bulk_resize_settings_are_a_bad_request(client):
+    response = client.post('/bulk-resize', data={**RESIZE_FIELDS, 'width': 'abc', 'images[]': [(io.BytesIO(jpeg_bytes()), 'a.jpg')]},
+                           content_type='multipart/form-data')
+    assert response.status_code == 400
+
+
+# --- Result cache ---
+
+def cache_key(func, **fields):
+    return main.result_cache_key(func, MultiDict(fields), FileStorage(stream=io.BytesIO(b'image bytes')))
+
+
+def test_cache_key_keeps_values_exactly_as_sent():
+    assert cache_key(main.resize_by_dimension, unit='cm', width='10', height='10') != \
+        cache_key(main.resize_by_dimension, unit='CM', width='10', height='10')
+    assert cache_key(main.convert_image, format='jpeg') != cache_key(main.convert_image, format='JPEG')
+
+
+def test_cache_key_ignores_parameters_the_tool_does_not_read():
+    assert cache_key(main.resize_by_dimension, unit='px', width='10', height='10', dpi='300') == \
+        cache_key(main.resize_by_dimension, unit='px', width='10', height='10', dpi='72')
+    assert cache_key(main.resize_by_dimension, unit='px', width='10', height='10', format='png', quality='10') == \
+        cache_key(main.resize_by_dimension, unit='px', width='10', height='10', format='png', quality='90')
+    assert cache_key(main.resize_by_dimension, unit='cm', width='10', height='10', dpi='300') != \
+        cache_key(main.resize_by_dimension, unit='cm', width='10', height='10', dpi='72')
+    assert cache_key(main.crop_image, crop_x='0', crop_y='0', crop_width='5', crop_height='5', top_text='x') == \
+        cache_key(main.crop_image, crop_x='0', crop_y='0', crop_width='5', crop_height='5')
+    assert cache_key(main.generate_meme, top_text='x') is None